@@ -1,39 +1,86 @@
+import atexit
 import configparser
 import logging
+import queue
+import re
 import sys
+from logging.handlers import QueueHandler, QueueListener
 import time
 import json
 import subprocess  # 用於 PowerShell 指令
+from functools import lru_cache
 from pathlib import Path
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # C-level JSON serializer; optional
+except ImportError:
+    orjson = None
+
+# --- Shared HTTP Session (connection reuse across retries) ---
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=0))
+SESSION.headers.update({'Accept': 'application/json', 'Connection': 'keep-alive'})
+
+
+def configure_session_retries(retry_count: int, retry_delay: int):
+    """Mounts urllib3-level retries (connection errors, 5xx) on the shared session."""
+    retry = Retry(
+        total=retry_count,
+        backoff_factor=retry_delay,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+    SESSION.mount('http://', adapter)
+    SESSION.mount('https://', adapter)
 
 # --- Environment Detection (GUI vs CLI) ---
-USE_GUI = False
-
-if sys.platform == 'win32':
-    try:
-        import tkinter as tk
-        from tkinter import messagebox
-        USE_GUI = True
-    except ImportError:
-        USE_GUI = False
-else:
-    USE_GUI = False
+# tkinter is only imported inside show_error_and_exit(); the success path
+# never pays the import cost.
+USE_GUI = (sys.platform == 'win32')
 
 
 def get_executable_version() -> str:
-    """Reads the version from the executable's properties."""
+    """Reads the version from the executable's properties.
+
+    The pywin32 lookup (heavy import + version-info call) is cached in a
+    version.cache file next to the executable; the cache is reused as long
+    as it is newer than the executable itself.
+    """
+    cache_path = get_resource_path('version.cache')
+    try:
+        if cache_path.stat().st_mtime >= Path(sys.executable).stat().st_mtime:
+            cached = cache_path.read_text(encoding='utf-8').strip()
+            if cached:
+                return cached
+    except OSError:
+        pass
+
     try:
         from win32api import GetFileVersionInfo, LOWORD, HIWORD
         info = GetFileVersionInfo(sys.executable, "\\")
         ms = info['FileVersionMS']
         ls = info['FileVersionLS']
-        return f"{HIWORD(ms)}.{LOWORD(ms)}.{HIWORD(ls)}.{LOWORD(ls)}"
+        version = f"{HIWORD(ms)}.{LOWORD(ms)}.{HIWORD(ls)}.{LOWORD(ls)}"
     except Exception:
         return f"Unknown"
 
+    try:
+        cache_path.write_text(version, encoding='utf-8')
+    except OSError:
+        pass
+    return version
+
 # --- Path Handling for PyInstaller ---
+# Cached: the frozen/base-path answer never changes within a process, and the
+# same relative paths (config.ini, output files, ...) are resolved repeatedly.
+@lru_cache(maxsize=None)
 def get_resource_path(relative_path: str) -> Path:
     if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
         base_path = Path(sys.executable).parent
@@ -44,27 +91,44 @@ def get_resource_path(relative_path: str) -> Path:
 
 # --- Logger Setup ---
 def setup_logging(log_file_path: str):
+    # Real handlers live behind a QueueListener thread so log calls on the
+    # main thread are just in-memory enqueues, never disk/console I/O.
+    formatter = logging.Formatter('[%(asctime)s] [%(levelname)s] %(message)s')
+    # delay=True: the log file is opened on first emit (on the listener
+    # thread), not at setup time.
+    file_handler = logging.FileHandler(log_file_path, mode='w', encoding='utf-8',
+                                       delay=True)
+    file_handler.setFormatter(formatter)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, file_handler, stream_handler,
+                             respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    # The queue side only merges args into the message; the listener's
+    # handlers apply the real format on the background thread.
     logging.basicConfig(
         level=logging.DEBUG,
-        format='[%(asctime)s] [%(levelname)s] %(message)s',
-        handlers=[logging.FileHandler(log_file_path, mode='w', encoding='utf-8'),
-                  logging.StreamHandler(sys.stdout)]
+        format='%(message)s',
+        handlers=[QueueHandler(log_queue)]
     )
 
 # --- Configuration Handling ---
-def load_config():
-    config_path = get_resource_path('config.ini')
-    if not config_path.is_file():
-        logging.error(f"Configuration file '{config_path}' not found.")
+def load_config(config: configparser.ConfigParser) -> dict | None:
+    """Extracts settings from an already-parsed config.ini (parsed once in __main__)."""
+    # A missing/unreadable config.ini leaves the parser empty; no stat() needed.
+    if not config.sections():
+        logging.error("Configuration file is missing or empty.")
         return None
 
-    config = configparser.ConfigParser()
-    config.read(config_path, encoding='utf-8')
-    
     try:
         settings = {
-            'mes_server': config.get('Global', 'MES_Server').strip('"\' '),
-            'mes_api': config.get('Global', 'MES_API').strip('"\' '),
+            # Normalized here once so main() can join them without per-run strips.
+            'mes_server': config.get('Global', 'MES_Server').strip('"\' ').rstrip('/'),
+            'mes_api': config.get('Global', 'MES_API').strip('"\' ').lstrip('/'),
             'mb_sn_path': config.get('Global', 'MB_SN_PATH').strip('"\' '),
             'retry_count': config.getint('Global', 'RETRY_COUNT', fallback=3),
             'retry_delay': config.getint('Global', 'RETRY_DELAY_SECONDS', fallback=5),
@@ -74,9 +138,21 @@ def load_config():
             'log_path': config.get('Global', 'LOG_PATH', fallback='./log/').strip('"\' '),
             'request_timeout': config.getint('Global', 'REQUEST_TIMEOUT_SECONDS', fallback=10)
         }
+
+        # Resolve the output locations and create their directories up front,
+        # so the write path in main() does no stat()/mkdir work.
+        settings['output_file_path'] = get_resource_path(settings['output_path'])
+        settings['raw_output_file_path'] = get_resource_path(settings['raw_output_path'])
+        for parent in {settings['output_file_path'].parent,
+                       settings['raw_output_file_path'].parent}:
+            try:
+                parent.mkdir(parents=True, exist_ok=True)
+            except OSError as e:
+                logging.warning(f"Could not create output directory '{parent}': {e}")
+
         logging.info("Configuration loaded successfully.")
         return settings
-    except configparser.NoOptionError as e:
+    except (configparser.NoSectionError, configparser.NoOptionError) as e:
         logging.error(f"Missing required option in config file: {e}")
         return None
 
@@ -120,75 +196,71 @@ def get_mb_sn(file_path: str) -> str | None:
 
     # --- 備案機制：讀取 SN.ini ---
     logging.info(f"Falling back to reading SN from file: {file_path}")
-    
-    sn_path = Path(file_path)
-    if not sn_path.is_file():
+
+    # EAFP: open directly and catch the miss rather than paying an extra
+    # stat() for is_file() first.
+    try:
+        sn = Path(file_path).read_text(encoding='utf-8').strip()
+    except FileNotFoundError:
         logging.error(f"SN file '{file_path}' not found.")
         return None
-    
-    try:
-        sn = sn_path.read_text().strip()
-        if not sn:
-            logging.error(f"SN file '{file_path}' is empty.")
-            return None
-        logging.info(f"Successfully read SN from file: {sn}")
-        return sn
     except Exception as e:
         logging.error(f"Error reading SN file '{file_path}': {e}")
         return None
 
+    if not sn:
+        logging.error(f"SN file '{file_path}' is empty.")
+        return None
+    logging.info(f"Successfully read SN from file: {sn}")
+    return sn
+
 # --- Template Processing Logic ---
-def process_mes_template(template_path: Path, mes_data: dict) -> list[str]:
+# Matches '...##key=' / '...##key:' in one pass; 'prefix' is everything up to
+# and including the separator, so the value can be appended directly.
+TEMPLATE_RE = re.compile(r'^(?P<prefix>.*?##\s*(?P<key>[^=:#]*?)\s*[=:])')
+
+
+def process_mes_template(template_path: Path, mes_data: dict) -> str:
     lines = []
     
     if template_path.is_file():
         try:
-            with open(template_path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-        except Exception as e:
+            lines = template_path.read_text(encoding='utf-8').splitlines(keepends=True)
+        except (OSError, UnicodeDecodeError) as e:
             logging.error(f"Error reading template file: {e}")
     else:
         logging.warning(f"Template file '{template_path}' not found. Generating default key-value list.")
 
-    remaining_keys = list(mes_data.keys())
+    remaining_keys = set(mes_data.keys())
     new_content = []
 
-    now = datetime.now()
-    timestamp_str = now.strftime("%Y-%m-%d %H:%M:%S") + f".{now.strftime('%f')[:2]}"
-    new_content.append(f"{timestamp_str}\n") 
+    # One strftime call; slicing %f down to two digits of fractional seconds.
+    timestamp_str = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-4]
+    new_content.append(timestamp_str)
+    new_content.append('\n')
 
     for line in lines:
-        line_stripped = line.strip()
-        if not line.endswith('\n'):
-            line += '\n'
-
-        if "##" in line_stripped and ("=" in line_stripped or ":" in line_stripped):
-            sep = "=" if "=" in line_stripped else ":"
-            try:
-                start_idx = line.find("##")
-                sep_idx = line.find(sep, start_idx)
-                
-                if sep_idx > start_idx:
-                    key_in_template = line[start_idx+2:sep_idx].strip()
-                    
-                    if key_in_template in mes_data:
-                        value = mes_data[key_in_template]
-                        prefix = line[:sep_idx+1]
-                        new_line = f"{prefix}{value}\n"
-                        new_content.append(new_line)
-                        
-                        if key_in_template in remaining_keys:
-                            remaining_keys.remove(key_in_template)
-                        continue
-            except Exception as e:
-                logging.warning(f"Failed to parse template line '{line_stripped}': {e}")
+        match = TEMPLATE_RE.match(line)
+        if match:
+            key_in_template = match['key']
+            if key_in_template in mes_data:
+                new_content.append(f"{match['prefix']}{mes_data[key_in_template]}\n")
+                remaining_keys.discard(key_in_template)
+                continue
 
         new_content.append(line)
 
+    # Only the final template line can lack a newline; fix it up once here
+    # instead of branching on every line in the loop.
+    if new_content and not new_content[-1].endswith('\n'):
+        new_content[-1] += '\n'
+
     if remaining_keys:
         new_keys_content = []
-        for key in remaining_keys:
-            new_keys_content.append(f"##{key}={mes_data[key]}\n")
+        # Iterate the original dict so unused keys keep their insertion order.
+        for key in mes_data:
+            if key in remaining_keys:
+                new_keys_content.append(f"##{key}={mes_data[key]}\n")
 
         if new_content and new_content[-1].strip() == "##":
             last_line = new_content.pop() 
@@ -197,13 +269,15 @@ def process_mes_template(template_path: Path, mes_data: dict) -> list[str]:
         else:
             new_content.extend(new_keys_content)
 
-    return new_content
+    return ''.join(new_content)
 
 # --- Error Handling ---
 def show_error_and_exit(message: str):
     logging.error(f"Displaying error and exiting: {message}")
     if USE_GUI:
         try:
+            import tkinter as tk
+            from tkinter import messagebox
             root = tk.Tk()
             root.withdraw()
             messagebox.showerror("Connection Failed", message)
@@ -214,16 +288,16 @@ def show_error_and_exit(message: str):
     sys.exit(1)
 
 # --- Main Application Logic ---
-def main():
+def main(cfg: configparser.ConfigParser):
     version = get_executable_version()
     logging.info(f"--- MES Tool Version: {version} ---")
-    
+
     if not USE_GUI:
         logging.info("Running in CLI mode (No GUI).")
     else:
         logging.info("Running in GUI mode.")
 
-    config = load_config()    
+    config = load_config(cfg)
     if not config:
         show_error_and_exit("Failed to load configuration.")
 
@@ -232,23 +306,33 @@ def main():
     if not mb_sn:
         show_error_and_exit("Failed to load SN configuration (PowerShell & File both failed).")
 
-    api_url = f"{config['mes_server'].rstrip('/')}/{config['mes_api'].lstrip('/')}{mb_sn}"
+    api_url = f"{config['mes_server']}/{config['mes_api']}{mb_sn}"
     logging.info(f"Preparing to connect to MES API: {api_url}")
 
+    configure_session_retries(config['retry_count'], config['retry_delay'])
+
     response = None
     mes_data_content = None
-    
+    parsed_response = None
+
     # 變數初始化
-    system_sn = None 
-    mes_station = None 
+    system_sn = None
+    mes_station = None
 
     # 2. Connect to MES
+    # HTTP-level retries (connection errors, 5xx) are delegated to urllib3's
+    # Retry on the session adapter. This loop only re-tries MES business-level
+    # failures ('success': false / unparsable body in an otherwise OK response).
     for attempt in range(config['retry_count']):
         try:
             logging.info(f"Connection attempt {attempt + 1}/{config['retry_count']}...")
-            response = requests.get(api_url, timeout=config['request_timeout'])
-            logging.debug(f"Response Status: {response.status_code}")
-            
+            response = SESSION.get(api_url, timeout=config['request_timeout'])
+            # Lazy %-args: nothing is formatted when DEBUG is disabled, and
+            # the body is reported by size rather than decoded via .text.
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug("Response Status: %s, Body Size: %s bytes",
+                              response.status_code, len(response.content))
+
             if response.status_code == 200:
                 logging.info("Successfully retrieved information from MES (HTTP 200 OK).")
                 try:
@@ -257,7 +341,8 @@ def main():
                     
                     if is_successful is True:
                         logging.info(f"MES business logic success ('success': {is_successful}).")
-                        
+
+                        parsed_response = resp_json
                         data_dict = resp_json.get('data', {})
 
                         # [Logic 1] Check System SN
@@ -288,12 +373,16 @@ def main():
                     logging.error("Failed to parse MES response as JSON.")
                     response = None
             else:
+                # Retryable statuses were already exhausted by urllib3; give up.
                 logging.warning(f"Connection failed, status code: {response.status_code}.")
                 response = None
-        
+                break
+
         except requests.exceptions.RequestException as e:
+            # urllib3 has already retried connection-level errors; don't loop again.
             logging.error(f"An HTTP Request exception occurred: {e}")
             response = None
+            break
 
         if response is None and attempt < config['retry_count'] - 1:
             logging.info(f"Retrying in {config['retry_delay']} seconds...")
@@ -302,18 +391,40 @@ def main():
     if mes_data_content is None or response is None:
         show_error_and_exit(f"Could not connect to MES system or retrieve valid data.\nURL: {api_url}")
 
+    # 4. Write outputs. Directories were created during config load and both
+    # payloads are prepared in memory first, so the processed and raw files
+    # are written back-to-back with nothing but queue-based log enqueues
+    # in between.
+    output_file_path = config['output_file_path']
+    raw_output_path = config['raw_output_file_path']
+
+    # Encode once and write bytes: skips the TextIOWrapper's incremental
+    # encoder, leaving a single os.write per file.
+    processed_bytes = mes_data_content.encode('utf-8')
+    # parsed_response was cached when the success check parsed the body;
+    # no need to re-run response.json() here.
+    if orjson is not None:
+        raw_bytes = orjson.dumps(parsed_response, option=orjson.OPT_INDENT_2)
+    else:
+        raw_bytes = (json.dumps(parsed_response, ensure_ascii=False, indent=4)
+                     .encode('utf-8'))
+
     # 4-1. Generate PROCESSED file (MES.txt)
-    output_file_path = get_resource_path(config['output_path'])
     try:
-        output_file_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(output_file_path, 'w', encoding='utf-8') as f:
-            f.writelines(mes_data_content)
+        output_file_path.write_bytes(processed_bytes)
         logging.info(f"Successfully wrote Processed MES information to '{output_file_path}'.")
     except IOError as e:
         logging.error(f"Failed to write to file '{output_file_path}': {e}")
         show_error_and_exit(f"Could not write to output file '{output_file_path}'.")
 
-    # 4-2. Generate SN file (sn.txt)
+    # 4-2. Generate RAW JSON file
+    try:
+        raw_output_path.write_bytes(raw_bytes)
+        logging.info(f"Successfully wrote Raw JSON information to '{raw_output_path}'.")
+    except IOError as e:
+        logging.error(f"Failed to write to raw file '{raw_output_path}': {e}")
+
+    # 4-3. Generate SN file (sn.txt)
     sn_output_path = output_file_path.parent / 'sn.txt'
     try:
         with open(sn_output_path, 'w', encoding='utf-8') as f:
@@ -323,7 +434,7 @@ def main():
         logging.error(f"Failed to write to SN file '{sn_output_path}': {e}")
         show_error_and_exit(f"Could not write to SN file '{sn_output_path}'.")
 
-    # 4-3. Generate Station file (station.txt) (NEW)
+    # 4-4. Generate Station file (station.txt) (NEW)
     station_output_path = output_file_path.parent / 'station.txt'
     try:
         with open(station_output_path, 'w', encoding='utf-8') as f:
@@ -333,27 +444,15 @@ def main():
         logging.error(f"Failed to write to Station file '{station_output_path}': {e}")
         show_error_and_exit(f"Could not write to Station file '{station_output_path}'.")
 
-    # 4-4. Generate RAW JSON file
-    raw_output_path = get_resource_path(config['raw_output_path'])
-    try:
-        raw_output_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(raw_output_path, 'w', encoding='utf-8') as f:
-            try:
-                json.dump(response.json(), f, ensure_ascii=False, indent=4)
-            except:
-                f.write(response.text)
-        logging.info(f"Successfully wrote Raw JSON information to '{raw_output_path}'.")
-    except IOError as e:
-        logging.error(f"Failed to write to raw file '{raw_output_path}': {e}")
-
     logging.info("Tool execution finished.")
     sys.exit(0)
 
 if __name__ == '__main__':
+    # Parse config.ini exactly once; the same parser is reused by load_config().
     config_file_path = get_resource_path('config.ini')
-    temp_config = configparser.ConfigParser()
-    temp_config.read(config_file_path, encoding='utf-8')
-    log_path = temp_config.get('Global', 'LOG_PATH', fallback='./log/').strip('"\' ')
+    cfg = configparser.ConfigParser()
+    cfg.read(config_file_path, encoding='utf-8')
+    log_path = cfg.get('Global', 'LOG_PATH', fallback='./log/').strip('"\' ')
     log_dir = get_resource_path(log_path)
     
     try:
@@ -366,8 +465,10 @@ if __name__ == '__main__':
     setup_logging(str(log_file))
 
     try:
-        main()
+        main(cfg)
     except KeyboardInterrupt:
         logging.warning("Program interrupted by user. Exiting.")
         sys.exit(130)
+    finally:
+        SESSION.close()
 